@@ -11,6 +11,9 @@ import uuid
 import json
 import sys
 import time
+import struct
+import array
+import mmap
 
 HOLE_TAG = 0
 OBSTACLE_TAG = 1
@@ -133,18 +136,15 @@ class Problem:
         self.name = str(len(list(self.graph.nodes))) + '-' + getRandomName()
 
     def initialize(self, savePics = False):
-        # Reset total cost, moves, and the cached distance matrix
-        self.totalCost = 0
-        self.currentMove = 0
-        self.moves = []
+        # Build the cached distance matrix and the rooted tree cache. These only depend on the graph,
+        # so they survive instance edits and re-plans.
         self.savePicsOfMoves = savePics
-        self.stateMap = {}
         nodeList = list(map(int,self.graph.nodes))
         self.cachedDistance = []
+        self.cachedTrees = {}
         self.branchVertexes = []
         i = 0
         for node in nodeList:
-            self.stateMap[node] = HOLE_TAG
             if self.graph.degree[node] > 2:
                 self.branchVertexes.append(node)
             if i > 0:
@@ -152,6 +152,27 @@ class Problem:
                 for _ in range(i):
                     self.cachedDistance[i - 1].append(-1)
             i += 1
+
+        # Remember the starting state, so we can come back to it after an edit
+        self.startRobot = self.robot
+        self.startObstacles = list(self.obstacles)
+        self.changedNodes = set()
+        self.deadline = None
+        self.flowSeconds = 0
+        self.flowPairs = 0
+        self.resetState()
+
+    # Reset total cost, moves, and the positions of the robot and obstacles to the starting state
+    def resetState(self):
+        self.totalCost = 0
+        self.currentMove = 0
+        self.moves = []
+        self.usedFallback = False
+        self.robot = self.startRobot
+        self.obstacles = list(self.startObstacles)
+        self.stateMap = {}
+        for node in list(map(int,self.graph.nodes)):
+            self.stateMap[node] = HOLE_TAG
         for node in self.obstacles:
             self.stateMap[node] = OBSTACLE_TAG
         self.stateMap[self.robot] = ROBOT_TAG
@@ -231,6 +252,14 @@ class Problem:
         return problemDict
 
     def tagBranches(self):
+        # The rooted tree only depends on where the robot is, so reuse it if we have been here before
+        if self.robot in self.cachedTrees:
+            (self.rootNode, self.parentDict, self.childrenDict, self.depth, self.nodeTags) = self.cachedTrees[self.robot]
+        else:
+            self.buildRootedTree()
+        self.countHolesInBranches()
+
+    def buildRootedTree(self):
         self.rootNode = self.robot
         self.parentDict = {self.robot: -1}
         self.childrenDict = {}
@@ -266,18 +295,21 @@ class Problem:
                 self.childrenDict[currentNode].append(neighbor)
                 
                 toVisit.append(neighbor)
-        
-        goalTag = nodeTags[self.goal]
+
+        self.nodeTags = nodeTags
+        self.cachedTrees[self.robot] = (self.rootNode, self.parentDict, self.childrenDict, self.depth, self.nodeTags)
+
+    def countHolesInBranches(self):
+        goalTag = self.nodeTags[self.goal]
         holesFront = 0
         holesBehind = 0
-        for key, value in nodeTags.items():
+        for key, value in self.nodeTags.items():
             if self.stateMap[key] == HOLE_TAG:
                 if value == goalTag:
                     holesFront += 1
                 else:
                     holesBehind+= 1
-        
-        self.nodeTags = nodeTags
+
         self.frontHoles = holesFront
         self.backHoles = holesBehind
 
@@ -356,7 +388,51 @@ class Problem:
         self.minHoles = minHoles
         self.pathToGoal = path
 
-    def tryToSolve(self):
+    # Cheap lower bound on the cost of any solution, in linear time over the path in the rooted tree.
+    # The robot has to travel at least distance(v(R),T). An obstacle at index i of that path cannot cross
+    # the robot, so it has to leave the path sideways at some exit: a path vertex j with a child off the
+    # path (cost at least |i-j|+1, which also covers the goal and going past it), or the robot's own
+    # vertex once the robot steps aside (cost at least i+1).
+    # Requires tagBranches() to have been called.
+    def computeLowerBound(self):
+        path = self.findPathFromRobotToNode(self.goal)
+        pathLength = len(path)
+
+        # Distance from each index to the nearest exit at or before it, then at or after it
+        nearestExit = []
+        exitDistance = None
+        if len(self.childrenDict[self.robot]) > 1:
+            exitDistance = 0
+        for i in range(pathLength):
+            if exitDistance != None:
+                exitDistance += 1
+            nextNode = path[i + 1] if i + 1 < pathLength else None
+            if any(child != nextNode for child in self.childrenDict[path[i]]):
+                exitDistance = 1
+            nearestExit.append(exitDistance)
+
+        exitDistance = None
+        obstacleDisplacement = 0
+        for i in reversed(range(pathLength)):
+            if exitDistance != None:
+                exitDistance += 1
+            nextNode = path[i + 1] if i + 1 < pathLength else None
+            if any(child != nextNode for child in self.childrenDict[path[i]]):
+                exitDistance = 1
+            if self.stateMap[path[i]] == OBSTACLE_TAG:
+                candidates = [x for x in [nearestExit[i], exitDistance] if x != None]
+                # No exit at all means the instance is unsolvable; any single move still costs 1
+                obstacleDisplacement += min(candidates) if len(candidates) > 0 else 1
+
+        robotDistance = pathLength
+        self.lowerBound = robotDistance + obstacleDisplacement
+        printStatus('Lower bound: {0} (distance {1} + displacement {2})'.format(self.lowerBound, robotDistance, obstacleDisplacement))
+        return self.lowerBound
+
+    # Parameter deadline: time.time() value after which expensive steps are replaced by cheap ones.
+    # The solver still finishes with a valid move sequence; usedFallback tells if that happened.
+    def tryToSolve(self, deadline = None):
+        self.deadline = deadline
         solutionFound = False
         impossibleInstance = False
 
@@ -393,6 +469,79 @@ class Problem:
 
         return solutionFound and not impossibleInstance
 
+    # Instance edits. These change the starting state of an initialized problem; call replan() afterwards.
+    def addObstacle(self, node):
+        self.checkNodeInGraph(node)
+        if node == self.startRobot or node in self.startObstacles:
+            raise ValueError('Cannot add obstacle at {0}'.format(node))
+        self.startObstacles.append(node)
+        self.changedNodes.add(node)
+
+    def removeObstacle(self, node):
+        self.checkNodeInGraph(node)
+        if node not in self.startObstacles:
+            raise ValueError('There is no obstacle at {0}'.format(node))
+        self.startObstacles.remove(node)
+        self.changedNodes.add(node)
+
+    def setGoal(self, node):
+        self.checkNodeInGraph(node)
+        self.changedNodes.add(self.goal)
+        self.changedNodes.add(node)
+        self.goal = node
+
+    def setRobot(self, node):
+        self.checkNodeInGraph(node)
+        if node in self.startObstacles:
+            raise ValueError('Cannot place robot on obstacle at {0}'.format(node))
+        self.changedNodes.add(self.startRobot)
+        self.changedNodes.add(node)
+        self.startRobot = node
+
+    def checkNodeInGraph(self, node):
+        if node not in self.graph:
+            raise ValueError('There is no node {0} in the graph'.format(node))
+
+    # Re-plan after one or more instance edits. The distance matrix and rooted trees are kept, and the
+    # previous moves are replayed until the first one that touches an edited node or is no longer valid.
+    # The solver then carries on from there. If that fails, we solve again from the starting state.
+    def replan(self, deadline = None):
+        previousMoves = self.moves
+        self.resetState()
+        self.tagBranches()
+        self.computeLowerBound()
+
+        for (origin, target, _) in previousMoves:
+            if origin in self.changedNodes or target in self.changedNodes:
+                break
+            if not self.isValidMove(origin, target):
+                break
+            if origin == self.robot:
+                self.moveRobotToNode(target)
+                self.tagBranches()
+            else:
+                self.moveObstacleToHole(origin, target)
+        printStatus('Reused {0} of {1} previous moves'.format(len(self.moves), len(previousMoves)))
+        self.changedNodes = set()
+
+        if self.tryToSolve(deadline):
+            return True
+        if len(self.moves) == 0:
+            return False
+
+        printStatus('Could not solve from the reused moves, starting over')
+        self.resetState()
+        return self.tryToSolve(deadline)
+
+    # Checks a move against the current state. Requires tagBranches() to have been called.
+    def isValidMove(self, origin, target):
+        if self.stateMap[target] != HOLE_TAG:
+            return False
+        if origin == self.robot:
+            path = self.findPathFromRobotToNode(target)
+            return all(self.stateMap[x] == HOLE_TAG for x in path)
+        return self.stateMap[origin] == OBSTACLE_TAG and self.nodeTags[origin] == self.nodeTags[target]
+
     def tryToMoveForward(self):
         distanceToGoal = len(self.pathToGoal)
         if self.frontHoles >= distanceToGoal:
@@ -594,25 +743,92 @@ class Problem:
         printStatus('Obstacles in path: ' + str(obstaclesInPathToNode))
         printStatus('Valid holes: ' + str(validHolesOutsidePathToNode))
         
+        # The min cost flow is optimal but can take seconds on large instances. If we can't afford it
+        # before the deadline, fall back to a greedy nearest hole assignment.
+        if self.isRunningOutOfTime(len(obstaclesInPathToNode) * len(validHolesOutsidePathToNode)):
+            assignment = self.fallBackToNearestHoles(obstaclesInPathToNode, validHolesOutsidePathToNode)
+        else:
+            assignment = self.assignHolesByMinCostFlow(obstaclesInPathToNode, validHolesOutsidePathToNode)
+
+        for obstacle in obstaclesInPathToNode:
+            self.moveObstacleToHole(obstacle, assignment[obstacle])
+
+    # Checks whether the deadline has passed, or whether a min cost flow over pairCount obstacle-hole
+    # pairs is expected to end after it, going by the average time per pair of the flows run so far
+    def isRunningOutOfTime(self, pairCount):
+        if self.deadline == None:
+            return False
+
+        expectedSeconds = 0
+        if self.flowPairs > 0:
+            expectedSeconds = pairCount * self.flowSeconds / self.flowPairs
+        return time.time() + expectedSeconds > self.deadline
+
+    # The deadline is checked while computing distances and before the flow, so running out of time
+    # falls back to assignNearestHoles. The distances computed so far stay cached.
+    def assignHolesByMinCostFlow(self, obstacles, holes):
+        distances = {}
+        for obstacle in obstacles:
+            for hole in holes:
+                if self.isRunningOutOfTime(0):
+                    return self.fallBackToNearestHoles(obstacles, holes)
+                distances[(obstacle, hole)] = self.distance(obstacle, hole)
+        if self.isRunningOutOfTime(len(obstacles) * len(holes)):
+            return self.fallBackToNearestHoles(obstacles, holes)
+
         # Solve as a min cost flow problem
+        startTime = time.time()
         m = nx.DiGraph()
 
-        m.add_node('source', demand=-len(obstaclesInPathToNode))
-        m.add_node('sink', demand=len(obstaclesInPathToNode))
-        for obstacle in obstaclesInPathToNode:
+        m.add_node('source', demand=-len(obstacles))
+        m.add_node('sink', demand=len(obstacles))
+        for obstacle in obstacles:
             m.add_edge('source',obstacle,capacity=1, weight=0)
         
-        for hole in validHolesOutsidePathToNode:
+        for hole in holes:
             m.add_edge(hole,'sink',capacity=1, weight=0)
 
-        for obstacle in obstaclesInPathToNode:
-            for hole in validHolesOutsidePathToNode:
-                m.add_edge(obstacle,hole,capacity=1, weight=self.distance(obstacle,hole))
+        for obstacle in obstacles:
+            for hole in holes:
+                m.add_edge(obstacle,hole,capacity=1, weight=distances[(obstacle, hole)])
         flowDict = nx.min_cost_flow(m)
-
-        for obstacle in obstaclesInPathToNode:
-            targetNode = [k for k,v in flowDict[obstacle].items() if v == 1][0]
-            self.moveObstacleToHole(obstacle, targetNode)
+        self.flowSeconds += time.time() - startTime
+        self.flowPairs += len(obstacles) * len(holes)
+
+        assignment = {}
+        for obstacle in obstacles:
+            assignment[obstacle] = [k for k,v in flowDict[obstacle].items() if v == 1][0]
+        return assignment
+
+    def fallBackToNearestHoles(self, obstacles, holes):
+        printStatus('Running out of time, assigning nearest holes instead')
+        self.usedFallback = True
+        return self.assignNearestHoles(obstacles, holes)
+
+    # Greedy alternative to the min cost flow: each obstacle, starting from the one closest to the robot,
+    # takes the nearest hole still free, found with a breadth first search over the rooted tree.
+    def assignNearestHoles(self, obstacles, holes):
+        freeHoles = set(holes)
+        assignment = {}
+        for obstacle in obstacles:
+            visited = {obstacle}
+            queue = [obstacle]
+            i = 0
+            while i < len(queue):
+                currentNode = queue[i]
+                i += 1
+                if currentNode in freeHoles:
+                    assignment[obstacle] = currentNode
+                    freeHoles.remove(currentNode)
+                    break
+                neighbors = list(self.childrenDict[currentNode])
+                if self.parentDict[currentNode] != -1:
+                    neighbors.append(self.parentDict[currentNode])
+                for neighbor in neighbors:
+                    if neighbor not in visited:
+                        visited.add(neighbor)
+                        queue.append(neighbor)
+        return assignment
 
     def moveObstacleToHole(self, obstacle, hole):
         if self.nodeTags[obstacle] != self.nodeTags[hole]:
@@ -681,7 +897,9 @@ def generateInstances(numberOfInstances):
         problem.export()
         printStatus('Saving as: ' + problem.name)
 
-def readInstance(fileName, savingPics):
+# Parameter timeBudget: seconds the solver may spend before switching to cheaper steps (default: no limit)
+# Parameter binaryMoveLog: also save the solution as a compact move log (see writeMoveLog)
+def readInstance(fileName, savingPics, timeBudget = None, binaryMoveLog = False):
     with open(fileName, 'r') as f:
         problemDict = json.load(f)
 
@@ -689,28 +907,147 @@ def readInstance(fileName, savingPics):
     p.read(problemDict)
     p.initialize(savePics = savingPics)
     # p.drawGraph()
+    p.tagBranches()
+    lowerBound = p.computeLowerBound()
     startTime = time.time()
-    hasSolution = p.tryToSolve()
+    deadline = None
+    if timeBudget != None:
+        deadline = startTime + timeBudget
+    hasSolution = p.tryToSolve(deadline)
     endTime = time.time()
     elapsedTime = endTime - startTime
     print('Finished in {0}'.format(elapsedTime))
+    if p.usedFallback:
+        print('Ran out of time budget, used nearest hole assignment for some steps')
 
     if hasSolution:
-        print('Solved with cost {0}!'.format(p.totalCost))
+        gap = p.totalCost - lowerBound
+        print('Solved with cost {0}! Lower bound {1}, gap {2}'.format(p.totalCost, lowerBound, gap))
         filePathA = 'solutions/' + p.name + '_solution.txt'
         filePathB = 'solutions/solution_' + p.name + '.txt'
-        solution = {"moves":p.moves, "cost":p.totalCost, "nodes":len(p.graph.nodes), "elapsedTime":elapsedTime, "solvable":True}
+        solution = {"moves":p.moves, "cost":p.totalCost, "lowerBound":lowerBound, "gap":gap, "nodes":len(p.graph.nodes), "elapsedTime":elapsedTime, "usedFallback":p.usedFallback, "solvable":True}
     else:
         print('Unsolvable instance :(')
         filePathA = 'solutions/' + p.name + '_unsolvable.txt'
         filePathB = 'solutions/unsolvable_' + p.name + '.txt'
-        solution = {"moves":[], "cost":-1, "nodes":len(p.graph.nodes), "elapsedTime":elapsedTime, "solvable":False}
+        solution = {"moves":[], "cost":-1, "lowerBound":lowerBound, "gap":-1, "nodes":len(p.graph.nodes), "elapsedTime":elapsedTime, "usedFallback":p.usedFallback, "solvable":False}
 
     # Save twice just to sort files more conveniently
     with open(filePathA,mode='w') as f:
         json.dump(solution, f)
     with open(filePathB,mode='w') as f:
         json.dump(solution, f)
+    if binaryMoveLog:
+        writeMoveLog('solutions/' + p.name + '_moves.bin', solution)
+
+# Compact binary move log. Layout (little endian):
+# - 48 byte header: magic, version, byte width of each column, move count, node count,
+#   cost, lower bound, elapsed time, solvable and usedFallback flags.
+# - Three columns (from, to, cost), each holding the differences between consecutive values,
+#   stored with the smallest signed integer width that fits and padded to a multiple of 4 bytes.
+MOVE_LOG_MAGIC = b'PMML'
+MOVE_LOG_VERSION = 1
+MOVE_LOG_HEADER = struct.Struct('<4sBBBBIIqqd??6x')
+MOVE_LOG_TYPECODES = {1:'b', 2:'h', 4:'i'}
+
+def deltaEncode(values):
+    deltas = []
+    previous = 0
+    for value in values:
+        deltas.append(value - previous)
+        previous = value
+
+    width = 1
+    for delta in deltas:
+        if delta < -2**15 or delta >= 2**15:
+            width = 4
+            break
+        if delta < -2**7 or delta >= 2**7:
+            width = 2
+
+    column = array.array(MOVE_LOG_TYPECODES[width], deltas)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return width, column.tobytes()
+
+def writeMoveLog(filePath, solution):
+    moves = solution["moves"]
+    columns = [deltaEncode([move[i] for move in moves]) for i in range(3)]
+    header = MOVE_LOG_HEADER.pack(MOVE_LOG_MAGIC, MOVE_LOG_VERSION, columns[0][0], columns[1][0], columns[2][0],
+        len(moves), solution["nodes"], solution["cost"], solution.get("lowerBound", -1),
+        solution["elapsedTime"], solution["solvable"], solution.get("usedFallback", False))
+
+    with open(filePath, mode='wb') as f:
+        f.write(header)
+        for (_, data) in columns:
+            f.write(data)
+            f.write(bytes(-len(data) % 4))
+
+# Reads a move log written by writeMoveLog. The file is memory-mapped, and iterating over it
+# yields (from, to, cost) tuples decoded on the fly, without building lists of the moves.
+class MoveLog:
+    def __init__(self, filePath):
+        with open(filePath, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < MOVE_LOG_HEADER.size:
+                raise ValueError('Not a move log: ' + filePath)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, fromWidth, toWidth, costWidth, self.moveCount, self.nodes, self.cost,
+            self.lowerBound, self.elapsedTime, self.solvable, self.usedFallback) = MOVE_LOG_HEADER.unpack_from(self.map)
+        widths = [fromWidth, toWidth, costWidth]
+        if magic != MOVE_LOG_MAGIC or version != MOVE_LOG_VERSION or any(x not in MOVE_LOG_TYPECODES for x in widths):
+            self.map.close()
+            raise ValueError('Not a move log: ' + filePath)
+
+        # The columns must fit exactly in the rest of the file, otherwise it was truncated or corrupted
+        expectedSize = MOVE_LOG_HEADER.size
+        for width in widths:
+            size = width * self.moveCount
+            expectedSize += size + (-size % 4)
+        fileSize = len(self.map)
+        if fileSize != expectedSize:
+            self.map.close()
+            raise ValueError('Move log {0} has {1} bytes, expected {2}'.format(filePath, fileSize, expectedSize))
+
+        self.columns = []
+        offset = MOVE_LOG_HEADER.size
+        for width in widths:
+            size = width * self.moveCount
+            self.columns.append(self.readColumn(offset, width, size))
+            offset += size + (-size % 4)
+
+    def readColumn(self, offset, width, size):
+        typecode = MOVE_LOG_TYPECODES[width]
+        if sys.byteorder == 'big':
+            column = array.array(typecode, self.map[offset:offset + size])
+            column.byteswap()
+            return column
+        return memoryview(self.map)[offset:offset + size].cast(typecode)
+
+    def __len__(self):
+        return self.moveCount
+
+    def __iter__(self):
+        origin = 0
+        target = 0
+        cost = 0
+        for (originDelta, targetDelta, costDelta) in zip(*self.columns):
+            origin += originDelta
+            target += targetDelta
+            cost += costDelta
+            yield (origin, target, cost)
+
+    def close(self):
+        for column in self.columns:
+            if isinstance(column, memoryview):
+                column.release()
+        self.columns = []
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 # Status printer
 def printStatus(text):
@@ -718,12 +1055,15 @@ def printStatus(text):
     # print(text)
     return
 
+def printUsageAndExit():
+    print('Usage:')
+    print('Generate intances: python ' + sys.argv[0] + ' -G [number of instances]')
+    print('Read instances: python ' + sys.argv[0] + ' -R [path of instance] [-D time budget in seconds] [-B save binary move log] [save pics of moves (default: False)]')
+    sys.exit(-1)
+
 if __name__ == "__main__":
     if len(sys.argv) < 3:
-        print('Usage:')
-        print('Generate intances: python ' + sys.argv[0] + ' -G [number of instances]')
-        print('Read instances: python ' + sys.argv[0] + ' -R [path of instance] [save pics of moves (default: False)]')
-        sys.exit(-1)
+        printUsageAndExit()
     
     if not os.path.exists('instances'):
         os.mkdir('instances')
@@ -734,8 +1074,25 @@ if __name__ == "__main__":
         generateInstances(sys.argv[2])
     
     if sys.argv[1] == '-R':
+        extraArgs = sys.argv[3:]
+        timeBudget = None
+        shouldSaveMoveLog = False
         shouldSavePics = False
-        if len(sys.argv) > 3:
-            shouldSavePics = True
-        readInstance(sys.argv[2], shouldSavePics)
+        while len(extraArgs) > 0:
+            if extraArgs[0] == '-D':
+                try:
+                    timeBudget = float(extraArgs[1])
+                except (IndexError, ValueError):
+                    printUsageAndExit()
+                if not math.isfinite(timeBudget) or timeBudget < 0:
+                    printUsageAndExit()
+                extraArgs = extraArgs[2:]
+            elif extraArgs[0] == '-B':
+                shouldSaveMoveLog = True
+                extraArgs = extraArgs[1:]
+            else:
+                # Any other argument means we should save pics of moves
+                shouldSavePics = True
+                extraArgs = extraArgs[1:]
+        readInstance(sys.argv[2], shouldSavePics, timeBudget, shouldSaveMoveLog)
         
\ No newline at end of file